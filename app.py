@@ -1,12 +1,14 @@
+import functools
 import json
 import os
 import uuid
 import random
 from datetime import datetime, timezone
-from typing import Dict, List, Tuple
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
-from flask import Flask, render_template, request, redirect, url_for, session, send_file, abort
+from flask import Flask, render_template, request, redirect, url_for, session, abort, jsonify, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, func, select
 from sqlalchemy.exc import IntegrityError
 
 
@@ -94,6 +96,11 @@ METRICS = [
     }
 ]
 
+# Derived once from the lists above
+METRIC_KEYS = tuple(m["key"] for m in METRICS)
+METRIC_FORM_FIELDS = tuple((k, f"{k}_A", f"{k}_B") for k in METRIC_KEYS)  # (key, field A, field B)
+DEMO_KEYS = tuple(q["key"] for q in DEMOGRAPHICS)
+
 
 # -----------------------------
 # App / DB setup
@@ -103,6 +110,8 @@ app = Flask(__name__, static_folder=STATIC_DIR, template_folder="templates")
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "dev-secret-change-me")
 app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{DB_PATH}"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+# Static files (incl. manifest.json) may be cached for 5 minutes; videos get a longer max-age below
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 300
 
 db = SQLAlchemy(app)
 
@@ -166,7 +175,42 @@ class DemographicResponse(db.Model):
 # -----------------------------
 # Manifest / sampling utilities
 # -----------------------------
-def load_manifest() -> Dict[str, Dict[str, List[str]]]:
+# (mtime, parsed manifest) of manifest.json; replaced as a single tuple so concurrent
+# requests never see a new mtime paired with old data
+_MANIFEST_CACHE: Tuple[Optional[float], Optional[Dict[str, Dict[str, List[str]]]]] = (None, None)
+
+
+def missing_videos(manifest: Dict[str, Dict[str, List[str]]]) -> List[str]:
+    # Descriptions of manifest videos that do not exist on disk. Each directory the
+    # manifest refers to is listed once, instead of one stat() per video; nothing
+    # outside those directories is walked.
+    files_by_dir = {}
+    missing = []
+    for set_name, methods in manifest.items():
+        for method_name, vids in methods.items():
+            for rel_path in vids:
+                rel_dir, name = os.path.split(os.path.normpath(rel_path))
+                if rel_dir not in files_by_dir:
+                    try:
+                        with os.scandir(os.path.join(STATIC_DIR, rel_dir)) as entries:
+                            files_by_dir[rel_dir] = {entry.name for entry in entries if entry.is_file()}
+                    except OSError:
+                        files_by_dir[rel_dir] = set()
+                if name not in files_by_dir[rel_dir]:
+                    abs_path = os.path.join(STATIC_DIR, rel_path)
+                    missing.append(f"set '{set_name}', method '{method_name}': {abs_path}")
+    return missing
+
+
+def load_manifest_with_mtime() -> Tuple[float, Dict[str, Dict[str, List[str]]]]:
+    # Re-parse and re-validate manifest.json only when its mtime changes
+    global _MANIFEST_CACHE
+
+    mtime = os.stat(MANIFEST_PATH).st_mtime
+    cached = _MANIFEST_CACHE
+    if cached[0] == mtime:
+        return cached
+
     with open(MANIFEST_PATH, "r", encoding="utf-8") as f:
         manifest = json.load(f)
 
@@ -180,15 +224,32 @@ def load_manifest() -> Dict[str, Dict[str, List[str]]]:
         for method_name, vids in methods.items():
             if not isinstance(vids, list) or len(vids) == 0:
                 raise ValueError(f"Set '{set_name}', method '{method_name}' must map to a non-empty list")
+            if not all(isinstance(v, str) for v in vids):
+                raise ValueError(f"Set '{set_name}', method '{method_name}' must list video paths as strings")
+
+    missing = missing_videos(manifest)
+    if missing:
+        raise FileNotFoundError("Missing video file(s):\n  " + "\n  ".join(missing))
+
+    _MANIFEST_CACHE = (mtime, manifest)
+    return _MANIFEST_CACHE
+
+
+def load_manifest() -> Dict[str, Dict[str, List[str]]]:
+    return load_manifest_with_mtime()[1]
 
-            for rel_path in vids:
-                abs_path = os.path.join(STATIC_DIR, rel_path)
-                if not os.path.isfile(abs_path):
-                    raise FileNotFoundError(
-                        f"Missing video file for set '{set_name}', method '{method_name}': {abs_path}"
-                    )
 
-    return manifest
+class Side(NamedTuple):
+    label: str   # "A" or "B" as shown in the UI
+    method: str
+    video: str   # path relative to STATIC_DIR
+
+
+class Trial(NamedTuple):
+    trial_index: int
+    set: str
+    left: Side
+    right: Side
 
 
 def generate_trials(
@@ -197,13 +258,19 @@ def generate_trials(
     seed: int,
     allow_video_repeats_within_participant: bool = False,
     counterbalance_sides: bool = True,
-) -> List[dict]:
+) -> Tuple[Trial, ...]:
     rng = random.Random(seed)
 
     set_names = list(manifest.keys())
     if len(set_names) == 0:
         raise ValueError("Manifest has no sets")
 
+    # List each set's methods once rather than per trial
+    method_names_by_set = {set_name: list(methods.keys()) for set_name, methods in manifest.items()}
+    for set_name, method_names in method_names_by_set.items():
+        if len(method_names) < 2:
+            raise ValueError(f"Set '{set_name}' has < 2 methods; cannot create A/B trial")
+
     # Tracks used videos to reduce repeats within a participant
     used_videos = set()
 
@@ -213,12 +280,9 @@ def generate_trials(
         set_name = rng.choice(set_names)
 
         methods_dict = manifest[set_name]
-        method_names = list(methods_dict.keys())
-        if len(method_names) < 2:
-            raise ValueError(f"Set '{set_name}' has < 2 methods; cannot create A/B trial")
 
         # 2) choose two different methods from same set
-        method_left, method_right = rng.sample(method_names, 2)
+        method_left, method_right = rng.sample(method_names_by_set[set_name], 2)
 
         # 3) choose one video from each method within the set
         vid_left = pick_video(
@@ -240,14 +304,32 @@ def generate_trials(
             method_left, method_right = method_right, method_left
             vid_left, vid_right = vid_right, vid_left
 
-        trials.append({
-            "trial_index": t,
-            "set": set_name,
-            "left": {"label": "A", "method": method_left, "video": vid_left},
-            "right": {"label": "B", "method": method_right, "video": vid_right},
-        })
+        trials.append(Trial(
+            trial_index=t,
+            set=set_name,
+            left=Side(label="A", method=method_left, video=vid_left),
+            right=Side(label="B", method=method_right, video=vid_right),
+        ))
 
-    return trials
+    return tuple(trials)
+
+
+@functools.lru_cache(maxsize=1024)
+def _generate_trials_cached(seed: int, manifest_id: float) -> Tuple[Trial, ...]:
+    # manifest_id (the manifest mtime) is only part of the cache key, so that
+    # editing manifest.json invalidates previously generated trials.
+    return generate_trials(
+        manifest=load_manifest(),
+        n_trials=N_TRIALS_PER_PARTICIPANT,
+        seed=seed,
+        allow_video_repeats_within_participant=False,
+        counterbalance_sides=True,
+    )
+
+
+def participant_trials(seed: int) -> Tuple[Trial, ...]:
+    mtime, _ = load_manifest_with_mtime()  # refreshes the cached manifest if the file changed
+    return _generate_trials_cached(seed, mtime)
 
 
 def pick_video(
@@ -261,6 +343,8 @@ def pick_video(
 
     # Try a few times to find an unused candidate.
     # If exhausted, fall back to allowing repeats for this pick.
+    # The full shuffle is kept on purpose: it fixes the RNG draw sequence, and
+    # therefore the trials each participant's seed maps to.
     shuffled = candidates[:]
     rng.shuffle(shuffled)
     for v in shuffled:
@@ -279,8 +363,12 @@ def participant_seed(participant_id: str) -> int:
 
 
 def participant_progress(participant_id: str) -> int:
-    # Number of completed trials
-    return Rating.query.filter_by(participant_id=participant_id).count()
+    # Number of completed trials. Counted once per session, then kept up to date by /submit.
+    if "current_trial" not in session:
+        session["current_trial"] = db.session.query(func.count(Rating.id)).filter(
+            Rating.participant_id == participant_id
+        ).scalar()
+    return session["current_trial"]
 
 
 def has_demographics(participant_id: str) -> bool:
@@ -291,6 +379,55 @@ def is_completed(participant_id: str) -> bool:
     return participant_progress(participant_id) >= N_TRIALS_PER_PARTICIPANT
 
 
+def parse_scores(values, from_json: bool = False) -> Tuple[Dict[str, int], Dict[str, int]]:
+    # Parse metric integers 0..5 from a form or JSON mapping.
+    # 0 indicates the user rated "n/a" for that metric.
+    # JSON values must already be integers; floats, bools and strings are rejected.
+    scores_A = {}
+    scores_B = {}
+    for key, field_A, field_B in METRIC_FORM_FIELDS:
+        raw_A = values.get(field_A)
+        raw_B = values.get(field_B)
+        if raw_A is None or raw_B is None:
+            abort(400, f"Missing score for {key}")
+        if from_json:
+            if type(raw_A) is not int or type(raw_B) is not int:
+                abort(400, f"Scores for {key} must be integers")
+            val_A, val_B = raw_A, raw_B
+        else:
+            val_A = int(raw_A)
+            val_B = int(raw_B)
+        if not (0 <= val_A <= 5 and 0 <= val_B <= 5):
+            abort(400, "Scores must be between 0 and 5")
+        scores_A[key] = val_A
+        scores_B[key] = val_B
+    return scores_A, scores_B
+
+
+def rating_values(participant_id: str, t: Trial, scores_A: Dict[str, int], scores_B: Dict[str, int]) -> dict:
+    # Column values for one row of the ratings table
+    return dict(
+        participant_id=participant_id,
+        created_at_utc=utc_now_str(),
+        trial_index=t.trial_index,
+        set_name=t.set,
+        method_a=t.left.method,
+        method_b=t.right.method,
+        video_a=t.left.video,
+        video_b=t.right.video,
+        left_label=t.left.label,
+        right_label=t.right.label,
+        metric_a_A=scores_A["metric_a"],
+        metric_b_A=scores_A["metric_b"],
+        metric_c_A=scores_A["metric_c"],
+        metric_d_A=scores_A["metric_d"],
+        metric_a_B=scores_B["metric_a"],
+        metric_b_B=scores_B["metric_b"],
+        metric_c_B=scores_B["metric_c"],
+        metric_d_B=scores_B["metric_d"],
+    )
+
+
 def utc_now_str() -> str:
     return datetime.now(timezone.utc).isoformat()
 
@@ -314,6 +451,21 @@ def ensure_participant():
         session["participant_id"] = uuid.uuid4().hex
 
 
+@app.after_request
+def cache_static_videos(response):
+    # Videos never change once a study is running, so let browsers (and any reverse
+    # proxy) keep them instead of re-fetching on back/refresh.
+    if (
+        response.status_code < 400
+        and request.path.startswith(app.static_url_path + "/")
+        and request.path.lower().endswith((".mp4", ".webm"))
+    ):
+        response.cache_control.public = True
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+    return response
+
+
 @app.route("/", methods=["GET"])
 def start():
     return render_template("start.html", n_trials=N_TRIALS_PER_PARTICIPANT, metrics=METRICS, contact_info=CONTACT_INFO)
@@ -325,7 +477,6 @@ def begin():
     if is_completed(participant_id):
         return redirect(url_for("done"))
 
-    session["seed"] = participant_seed(participant_id)
     # If demographics already filled, do not ask again
     if has_demographics(participant_id):
         return redirect(url_for("trial"))
@@ -346,8 +497,7 @@ def demographics():
     if request.method == "POST":
         responses = {}
 
-        for q in DEMOGRAPHICS:
-            key = q["key"]
+        for key in DEMO_KEYS:
             val = request.form.get(key)
             if val is not None:
                 responses[key] = val
@@ -379,16 +529,7 @@ def trial():
     if is_completed(participant_id):
         return redirect(url_for("done"))
 
-    manifest = load_manifest()
-
-    seed = session.get("seed", participant_seed(participant_id))
-    trials = generate_trials(
-        manifest=manifest,
-        n_trials=N_TRIALS_PER_PARTICIPANT,
-        seed=seed,
-        allow_video_repeats_within_participant=False,
-        counterbalance_sides=True,
-    )
+    trials = participant_trials(participant_seed(participant_id))
 
     idx = participant_progress(participant_id)
     t = trials[idx]
@@ -396,17 +537,17 @@ def trial():
     app.logger.info(
         "Serving trial %d: set=%s | left=%s | right=%s",
         idx,
-        t.get("set"),
-        t["left"]["video"],
-        t["right"]["video"],
+        t.set,
+        t.left.video,
+        t.right.video,
     )
 
     return render_template(
         "trial.html",
         trial_index=idx,
         n_trials=N_TRIALS_PER_PARTICIPANT,
-        left=t["left"],
-        right=t["right"],
+        left=t.left,
+        right=t.right,
         metrics=METRICS,
     )
 
@@ -419,70 +560,73 @@ def submit():
     if is_completed(participant_id):
         return redirect(url_for("done"))
 
-    manifest = load_manifest()
-    seed = session.get("seed", participant_seed(participant_id))
-    trials = generate_trials(
-        manifest=manifest,
-        n_trials=N_TRIALS_PER_PARTICIPANT,
-        seed=seed,
-        allow_video_repeats_within_participant=False,
-        counterbalance_sides=True,
-    )
+    trials = participant_trials(participant_seed(participant_id))
 
     idx = participant_progress(participant_id)
     t = trials[idx]
 
-    # Parse metric integers 0..5. 0 indicates the user rated "n/a" for that metric.
-    scores_A = {}
-    scores_B = {}
-    for m in METRICS:
-        key = m["key"]
-        raw_A = request.form.get(f"{key}_A")
-        raw_B = request.form.get(f"{key}_B")
-        if raw_A is None or raw_B is None:
-            abort(400, f"Missing score for {key}")
-        val_A = int(raw_A)
-        val_B = int(raw_B)
-        if not (0 <= val_A <= 5 and 0 <= val_B <= 5):
-            abort(400, "Scores must be between 0 and 5")
-        scores_A[key] = val_A
-        scores_B[key] = val_B
+    scores_A, scores_B = parse_scores(request.form)
 
-    # Prevent accidental duplicates (e.g., back button / double submit)
-    existing = Rating.query.filter_by(participant_id=participant_id, trial_index=idx).first()
-    if existing is not None:
-        return redirect(url_for("trial"))
-
-    row = Rating(
-        participant_id=participant_id,
-        created_at_utc=utc_now_str(),
-        trial_index=idx,
-        set_name=t["set"],
-        method_a=t["left"]["method"],
-        method_b=t["right"]["method"],
-        video_a=t["left"]["video"],
-        video_b=t["right"]["video"],
-        left_label=t["left"]["label"],
-        right_label=t["right"]["label"],
-        metric_a_A=scores_A["metric_a"],
-        metric_b_A=scores_A["metric_b"],
-        metric_c_A=scores_A["metric_c"],
-        metric_d_A=scores_A["metric_d"],
-        metric_a_B=scores_B["metric_a"],
-        metric_b_B=scores_B["metric_b"],
-        metric_c_B=scores_B["metric_c"],
-        metric_d_B=scores_B["metric_d"],
-    )
+    row = Rating(**rating_values(participant_id, t, scores_A, scores_B))
 
+    # Accidental duplicates (e.g., back button / double submit) are rejected by the
+    # uq_participant_trial constraint
     try:
         db.session.add(row)
         db.session.commit()
+        session["current_trial"] = idx + 1
     except IntegrityError:
         db.session.rollback()
+        session.pop("current_trial", None)  # out of sync with the DB; recount on next request
 
     return redirect(url_for("trial"))
 
 
+@app.route("/submit_all", methods=["POST"])
+def submit_all():
+    # Batch variant of /submit: accepts a JSON array of
+    # {"trial_index": int, "metric_a_A": int, ..., "metric_d_B": int} objects
+    # for the participant's next consecutive trials, and stores them with a
+    # single multi-row INSERT and one commit.
+    participant_id = session.get("participant_id")
+    if not participant_id:
+        abort(400, "No participant session")
+
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, list) or len(payload) == 0:
+        abort(400, "Expected a non-empty JSON array of trial results")
+
+    if not all(isinstance(result, dict) for result in payload):
+        abort(400, "Each trial result must be a JSON object")
+
+    # Progress is a row count, so only the next consecutive trials may be stored;
+    # a gap would make /trial serve the wrong index from then on.
+    progress = participant_progress(participant_id)
+    expected = list(range(progress, progress + len(payload)))
+    indices = [result.get("trial_index") for result in payload]
+    if any(type(idx) is not int for idx in indices) or indices != expected \
+            or progress + len(payload) > N_TRIALS_PER_PARTICIPANT:
+        abort(400, f"trial_index values must be {expected} (within {N_TRIALS_PER_PARTICIPANT} trials)")
+
+    trials = participant_trials(participant_seed(participant_id))
+
+    rows = []
+    for idx, result in zip(indices, payload):
+        scores_A, scores_B = parse_scores(result, from_json=True)
+        rows.append(rating_values(participant_id, trials[idx], scores_A, scores_B))
+
+    try:
+        db.session.execute(Rating.__table__.insert(), rows)
+        db.session.commit()
+        session["current_trial"] = progress + len(rows)
+    except IntegrityError:
+        db.session.rollback()
+        session.pop("current_trial", None)  # out of sync with the DB; recount on next request
+        abort(409, "One or more trials were already submitted")
+
+    return jsonify({"saved": len(rows)})
+
+
 @app.route("/done", methods=["GET"])
 def done():
     return render_template("done.html")
@@ -495,72 +639,89 @@ def reset():
     if not (request.host.startswith("127.0.0.1") or request.host.startswith("localhost")):
         abort(404)
 
-    session.clear()  # clears participant_id, seed, etc.
+    session.clear()  # clears participant_id, current_trial, etc.
     return redirect(url_for("start"))
 
 
 @app.route("/export.csv", methods=["GET"])
 def export_csv():
     import csv
-    import json
-    from io import StringIO, BytesIO
+    from io import BytesIO, TextIOWrapper
 
     require_export_token()
 
-    # Demographic columns are defined by the global DEMOGRAPHICS list
-    demo_keys = [q["key"] for q in DEMOGRAPHICS]
-
-    # Load demographics once, build a participant_id -> dict map
-    demo_rows = DemographicResponse.query.all()
-    demo_by_pid = {}
-    for d in demo_rows:
-        try:
-            demo_by_pid[d.participant_id] = json.loads(d.responses_json or "{}")
-        except json.JSONDecodeError:
-            demo_by_pid[d.participant_id] = {}
-
-    sio = StringIO()
-    writer = csv.writer(sio)
-
-    writer.writerow([
-        "participant_id", "created_at_utc", "trial_index", "set_name",
-        "method_left", "video_left", "method_right", "video_right",
-        "metric_a_left", "metric_b_left", "metric_c_left", "metric_d_left",
-        "metric_a_right", "metric_b_right", "metric_c_right", "metric_d_right",
-        *demo_keys,  # one column per demographic key
-    ])
-
-    rows = Rating.query.order_by(Rating.participant_id, Rating.trial_index).all()
-    for r in rows:
-        demo = demo_by_pid.get(r.participant_id, {})
+    def generate():
+        # csv.writer encodes straight into a small byte buffer that is drained after
+        # every row, so the export is streamed instead of built in memory.
+        buf = BytesIO()
+        writer = csv.writer(TextIOWrapper(buf, encoding="utf-8", newline="", write_through=True))
+
+        def drain() -> bytes:
+            data = buf.getvalue()
+            buf.seek(0)
+            buf.truncate(0)
+            return data
+
         writer.writerow([
-            r.participant_id, r.created_at_utc, r.trial_index, r.set_name,
-            r.method_a, r.video_a, r.method_b, r.video_b,
-            r.metric_a_A, r.metric_b_A, r.metric_c_A, r.metric_d_A,
-            r.metric_a_B, r.metric_b_B, r.metric_c_B, r.metric_d_B,
-            *[demo.get(k, "") for k in demo_keys],
+            "participant_id", "created_at_utc", "trial_index", "set_name",
+            "method_left", "video_left", "method_right", "video_right",
+            "metric_a_left", "metric_b_left", "metric_c_left", "metric_d_left",
+            "metric_a_right", "metric_b_right", "metric_c_right", "metric_d_right",
+            *DEMO_KEYS,  # one column per demographic key (see DEMOGRAPHICS)
         ])
+        yield drain()
+
+        # Plain column tuples in CSV order, with each demographic answer pulled out of
+        # the joined JSON blob by SQLite (NULL -> empty cell); no ORM objects are built
+        stmt = (
+            select(
+                Rating.participant_id, Rating.created_at_utc, Rating.trial_index, Rating.set_name,
+                Rating.method_a, Rating.video_a, Rating.method_b, Rating.video_b,
+                Rating.metric_a_A, Rating.metric_b_A, Rating.metric_c_A, Rating.metric_d_A,
+                Rating.metric_a_B, Rating.metric_b_B, Rating.metric_c_B, Rating.metric_d_B,
+                *[func.json_extract(DemographicResponse.responses_json, f'$."{k}"').label(k) for k in DEMO_KEYS],
+            )
+            .outerjoin(DemographicResponse, Rating.participant_id == DemographicResponse.participant_id)
+            .order_by(Rating.participant_id, Rating.trial_index)
+        )
+        for r in db.session.execute(stmt).yield_per(1000):
+            writer.writerow(r)
+            yield drain()
 
-    # Convert to bytes for send_file
-    bio = BytesIO(sio.getvalue().encode("utf-8"))
-    bio.seek(0)
-
-    return send_file(
-        bio,
+    return Response(
+        stream_with_context(generate()),
         mimetype="text/csv; charset=utf-8",
-        as_attachment=True,
-        download_name="results.csv",
+        headers={"Content-Disposition": "attachment; filename=results.csv"},
     )
 
 
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets /export.csv readers run alongside /submit writers, and
+    # synchronous=NORMAL skips the per-commit fsync (still crash-safe in WAL mode)
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA cache_size=-20000")
+    cursor.close()
+
 
 def init_db():
     with app.app_context():
+        if not event.contains(db.engine, "connect", set_sqlite_pragmas):
+            event.listen(db.engine, "connect", set_sqlite_pragmas)
         db.create_all()
 
+    # Report manifest problems without taking the whole app down: /export.csv keeps
+    # working and trial pages raise the same error until the manifest is fixed.
+    try:
+        load_manifest()
+    except (OSError, ValueError) as e:
+        app.logger.error("Invalid manifest %s: %s", MANIFEST_PATH, e)
+
 init_db()
 
 if __name__ == "__main__":
-    init_db()
     # In production, run behind gunicorn/uvicorn + reverse proxy
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -1,10 +1,108 @@
 #!/usr/bin/env python3
 
+import hashlib
 import json
+import os
+import tempfile
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from collections import defaultdict
 import argparse
 
+try:
+    import orjson  # optional: faster JSON encoding
+except ImportError:
+    orjson = None
+
+
+def _dumps(obj) -> str:
+    # Compact, non-ASCII-escaping JSON; identical output with or without orjson
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+# Every casing of ".mp4", so the suffix check needs no lowercased copy of each name
+VIDEO_SUFFIXES = frozenset({".mp4", ".mP4", ".Mp4", ".MP4"})
+
+
+def _is_video(entry: os.DirEntry) -> bool:
+    return entry.name[entry.name.rfind("."):] in VIDEO_SUFFIXES and entry.is_file()
+
+
+def _invalid_structure(video_path: str) -> RuntimeError:
+    return RuntimeError(
+        f"Invalid directory structure for video: {video_path}\n"
+        "Expected: videos/<set>/<method>/<video>.mp4"
+    )
+
+
+def _sorted_subdirs(path) -> list:
+    # Subdirectory names of a videos/ or videos/<set>/ directory; videos are not allowed at these levels
+    subdirs = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+            elif _is_video(entry):
+                raise _invalid_structure(entry.path)
+    return sorted(subdirs)
+
+
+def list_videos(method_path: str) -> list:
+    """Sorted .mp4 file names (any case) in one method directory; subdirectories are not read."""
+    with os.scandir(method_path) as video_entries:
+        # One sorted() over a generator: no intermediate list, no append loop.
+        # is_file() uses the type cached on the DirEntry, so it costs no extra stat().
+        return sorted(video_entry.name for video_entry in video_entries if _is_video(video_entry))
+
+
+def walk_videos(videos_dir: Path, max_workers: int = 32):
+    """
+    Yield (set_name, method_name, [sorted relative video paths]) for every
+    method directory that contains videos, in sorted set/method order.
+    Method directories are listed concurrently, which hides per-directory
+    latency on network filesystems. At most max_workers listings are in flight
+    or waiting to be yielded at any time, so memory stays bounded by that many
+    method lists.
+    """
+    # Resolve once; everything below is plain string composition on this root
+    root = str(videos_dir.resolve())
+    root_name = os.path.basename(root)  # usually "videos"
+
+    # Expect: videos/<set>/<method>/<video>.mp4
+    # Walk exactly three levels with os.scandir; DirEntry caches the file type,
+    # so no extra stat() calls or Path objects are needed per video.
+    method_dirs = [
+        (set_name, method_name)
+        for set_name in _sorted_subdirs(root)
+        for method_name in _sorted_subdirs(os.path.join(root, set_name))
+    ]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Sliding window of futures, consumed in sorted order
+        todo = iter(method_dirs)
+        pending = deque()
+
+        def submit_next():
+            item = next(todo, None)
+            if item is not None:
+                set_name, method_name = item
+                path = os.path.join(root, set_name, method_name)
+                pending.append((set_name, method_name, executor.submit(list_videos, path)))
+
+        for _ in range(max_workers):
+            submit_next()
+
+        while pending:
+            set_name, method_name, future = pending.popleft()
+            names = future.result()
+            submit_next()
+            if names:
+                prefix = f"{root_name}/{set_name}/{method_name}/"
+                yield set_name, method_name, [prefix + name for name in names]
+
 
 def build_manifest(videos_dir: Path) -> dict:
     """
@@ -15,36 +113,111 @@ def build_manifest(videos_dir: Path) -> dict:
       }
     }
     """
-    manifest = defaultdict(lambda: defaultdict(list))
+    manifest = {}
+    for set_name, method_name, videos in walk_videos(videos_dir):
+        manifest.setdefault(set_name, {})[method_name] = videos
+    return manifest
 
-    videos_dir = videos_dir.resolve()
-    root_name = videos_dir.name  # usually "videos"
 
-    for video_path in sorted(videos_dir.rglob("*.mp4")):
-        # Expect: videos/<set>/<method>/<video>.mp4
-        try:
-            rel = video_path.relative_to(videos_dir)
-            set_name = rel.parts[0]
-            method_name = rel.parts[1]
-        except Exception:
-            raise RuntimeError(
-                f"Invalid directory structure for video: {video_path}\n"
-                "Expected: videos/<set>/<method>/<video>.mp4"
-            )
-
-        rel_path = str(Path(root_name) / rel)
-        manifest[set_name][method_name].append(rel_path)
-
-    # sort for determinism
-    manifest_sorted = {
-        set_name: {
-            method: sorted(videos)
-            for method, videos in sorted(methods.items())
-        }
-        for set_name, methods in sorted(manifest.items())
-    }
+@contextmanager
+def _atomic_write(out_path: Path):
+    """
+    Open a temp file next to out_path for writing and move it onto out_path only
+    once the block finishes, so a failed walk leaves the previous manifest intact
+    and readers (app.py reloads on mtime change) never see a half-written file.
+    """
+    out_path = Path(out_path)
+    f = tempfile.NamedTemporaryFile(
+        "w", encoding="utf-8", dir=out_path.parent, prefix=f".{out_path.name}.", suffix=".tmp", delete=False
+    )
+    try:
+        with f:
+            yield f
+        # NamedTemporaryFile is created 0600; give the result the usual permissions
+        if out_path.exists():
+            mode = out_path.stat().st_mode & 0o777
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        os.chmod(f.name, mode)
+        os.replace(f.name, out_path)
+    except BaseException:
+        os.unlink(f.name)
+        raise
+
+
+def write_manifest(videos_dir: Path, out_path: Path) -> None:
+    """
+    Write the manifest to out_path as it is walked, without building the full
+    dict first. Output matches json.dump(build_manifest(...), f, indent=2, ensure_ascii=False).
+    """
+    with _atomic_write(out_path) as f:
+        f.write("{")
+        current_set = None
+        first_method = True
+        for set_name, method_name, videos in walk_videos(videos_dir):
+            if set_name != current_set:
+                if current_set is not None:
+                    f.write("\n  },")
+                f.write(f"\n  {_dumps(set_name)}: {{")
+                current_set = set_name
+                first_method = True
+            if not first_method:
+                f.write(",")
+            first_method = False
+            f.write(f"\n    {_dumps(method_name)}: [")
+            f.write(",".join(f"\n      {_dumps(v)}" for v in videos))
+            f.write("\n    ]")
+        f.write("\n  }\n}" if current_set is not None else "}")
+
 
-    return manifest_sorted
+def write_manifest_jsonl(videos_dir: Path, out_path: Path) -> None:
+    """
+    Write the manifest as JSON Lines: one {"set", "method", "path"} record per
+    video, so large manifests can be streamed, grepped or filtered line by line.
+    """
+    with _atomic_write(out_path) as f:
+        for set_name, method_name, videos in walk_videos(videos_dir):
+            for v in videos:
+                f.write(_dumps({"set": set_name, "method": method_name, "path": v}) + "\n")
+
+
+def tree_fingerprint(videos_dir: Path) -> str:
+    """
+    Hash of the mtimes of the videos directory and its set/method subdirectories.
+    A directory's mtime changes whenever an entry is added, removed or renamed in it,
+    which is all the manifest depends on, so no per-video stat() is needed.
+    These three levels are the only directories the walk reads (subfolders of method
+    directories are ignored), so every input to the manifest is covered.
+    """
+    root = str(videos_dir.resolve())
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{root}:{os.stat(root).st_mtime_ns}\n".encode())
+    for set_name in _sorted_subdirs(root):
+        set_path = os.path.join(root, set_name)
+        h.update(f"{set_name}:{os.stat(set_path).st_mtime_ns}\n".encode())
+        for method_name in _sorted_subdirs(set_path):
+            method_path = os.path.join(set_path, method_name)
+            h.update(f"{set_name}/{method_name}:{os.stat(method_path).st_mtime_ns}\n".encode())
+    return h.hexdigest()
+
+
+def cache_path_for(out_path: Path) -> Path:
+    """
+    Fingerprint sidecar for one output file. Kept in the user's cache directory,
+    not next to the manifest, so it is never served from the static folder, and
+    keyed by the output path so json and jsonl outputs do not evict each other.
+    """
+    cache_dir = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "build_manifest"
+    key = hashlib.blake2b(str(out_path.resolve()).encode(), digest_size=16).hexdigest()
+    return cache_dir / f"{key}.json"
+
+
+def output_stamp(out_path: Path) -> list:
+    # Detects hand edits to the written manifest
+    st = os.stat(out_path)
+    return [st.st_mtime_ns, st.st_size]
 
 
 def main():
@@ -57,16 +230,45 @@ def main():
     parser.add_argument(
         "--out",
         type=Path,
-        default=Path("manifest.json"),
-        help="Output manifest file (default: manifest.json)"
+        default=None,
+        help="Output manifest file (default: manifest.json, or manifest.jsonl with --format jsonl)"
+    )
+    parser.add_argument(
+        "--format",
+        choices=["json", "jsonl"],
+        default="json",
+        help="json: nested manifest read by app.py (default); jsonl: one {set, method, path} record per line"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Rebuild even if the videos directory looks unchanged since the last run"
     )
 
     args = parser.parse_args()
+    args.out = args.out or Path("manifest.jsonl" if args.format == "jsonl" else "manifest.json")
+
+    # Skip the full walk when the tree is unchanged since the manifest was last written
+    cache_path = cache_path_for(args.out)
+    fingerprint = tree_fingerprint(args.videos_dir)
+    if not args.force and args.out.exists() and cache_path.exists():
+        try:
+            cached = json.loads(cache_path.read_text())
+        except ValueError:
+            cached = None
+        if cached == {"fingerprint": fingerprint, "format": args.format, "output": output_stamp(args.out)}:
+            print(f"✓ Videos unchanged; {args.out} is up to date")
+            return
 
-    manifest = build_manifest(args.videos_dir)
+    if args.format == "jsonl":
+        write_manifest_jsonl(args.videos_dir, args.out)
+    else:
+        write_manifest(args.videos_dir, args.out)
 
-    with open(args.out, "w") as f:
-        json.dump(manifest, f, indent=2)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    cache_path.write_text(json.dumps(
+        {"fingerprint": fingerprint, "format": args.format, "output": output_stamp(args.out)}
+    ))
 
     print(f"✓ Wrote manifest to {args.out}")
 
@@ -1,33 +1,37 @@
+from importlib.util import find_spec
+
+import numpy as np
 import pandas as pd
 
-df = pd.read_csv("~/Downloads/results.csv")
+id_cols = ["participant_id", "trial_index", "set_name"]
+metrics = ["metric_a", "metric_b", "metric_c", "metric_d"]
 
-left = (
-    df[["participant_id", "trial_index", "set_name", "metric_a_left", "metric_b_left", "metric_c_left", "metric_d_left"]]
-    .rename(columns={
-        "metric_a_left": "metric_a",
-        "metric_b_left": "metric_b",
-        "metric_c_left": "metric_c",
-        "metric_d_left": "metric_d",
-    })
-    .assign(video="A")
-)
+metric_cols = [f"{m}_{side}" for m in metrics for side in ("left", "right")]
 
-right = (
-    df[["participant_id", "trial_index", "set_name", "metric_a_right", "metric_b_right", "metric_c_right", "metric_d_right"]]
-    .rename(columns={
-        "metric_a_right": "metric_a",
-        "metric_b_right": "metric_b",
-        "metric_c_right": "metric_c",
-        "metric_d_right": "metric_d",
-    })
-    .assign(video="B")
+# Only parse the columns used below, and parse metric scores as numbers while reading
+# rather than coercing them afterwards.
+# Use pyarrow's multithreaded CSV parser when it is installed.
+df = pd.read_csv(
+    "~/Downloads/results.csv",
+    engine="pyarrow" if find_spec("pyarrow") else "c",
+    usecols=id_cols + metric_cols,
+    dtype={c: "float32" for c in metric_cols},
 )
 
-long = pd.concat([left, right], ignore_index=True)
+# One row per (trial, video): metric_x_left -> video A, metric_x_right -> video B.
+# Both halves are written into one preallocated array, so no intermediate frames are built.
+n = len(df)
+values = np.empty((2 * n, len(metrics)), dtype=np.float32)
+values[:n] = df[[f"{m}_left" for m in metrics]].to_numpy()
+values[n:] = df[[f"{m}_right" for m in metrics]].to_numpy()
 
-# Optional: ensure numeric dtype
-long[["metric_a", "metric_b", "metric_c", "metric_d"]] = long[["metric_a", "metric_b", "metric_c", "metric_d"]].apply(pd.to_numeric)
+long = pd.DataFrame({
+    **{c: np.tile(df[c].to_numpy(), 2) for c in id_cols},
+    **{m: values[:, k] for k, m in enumerate(metrics)},
+    # Low-cardinality labels as categoricals (small integer codes)
+    "video": pd.Categorical.from_codes(np.repeat(np.array([0, 1], dtype=np.int8), n), categories=["A", "B"]),
+})
+long["set_name"] = long["set_name"].astype("category")
 
 print(long.head())
 print(long.dtypes)